@@ -1,20 +1,43 @@
-import io
+import atexit
 import subprocess
 import time
-import multiprocessing
-from collections import namedtuple
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate
+from multiprocessing import shared_memory
 
 import PIL.Image
 import glob
 import os
-from subprocess import getoutput, check_output
+from subprocess import check_output
 
 import pyautogui
 import pyscreeze
 import numpy as np
 import cv2
+import Xlib.display
+from Xlib import X
+from Xlib.ext import xtest
 
-window_id = int(getoutput('xdotool search --classname ZachtronicsSolitaire'.strip()))
+# find and grab the window, and click on it, straight through the X server instead of going through xdotool,
+# xwd and imagemagick
+x_display = Xlib.display.Display()
+
+
+# the same as xdotool search --classname, finds the window whose WM_CLASS instance name is classname
+def find_window_by_classname(window, classname):
+    wm_class = window.get_wm_class()
+    if wm_class is not None and wm_class[0] == classname:
+        return window
+    for child in window.query_tree().children:
+        found = find_window_by_classname(child, classname)
+        if found is not None:
+            return found
+    return None
+
+
+game_window = find_window_by_classname(x_display.screen().root, 'ZachtronicsSolitaire')
+assert game_window is not None, 'is the game running?'
 # there are 10 starting stacks (and a stack in the middle, that should be skipped)
 num_starting_cards_per_stack = 7
 to_top_of_stacks_px = 392
@@ -34,142 +57,359 @@ gaps_until_next_stack = [
     28,
     30,
     29]
+# gaps_until_next_stack summed up to and including each stack
+total_gaps_until_stack = list(accumulate(gaps_until_next_stack))
 
 
 # grab images of all cards in all stacks (except the middle) -- should be 70 cards
+# these are numpy views into the image, not copies
 def get_card_images(pil_image):
-    card_images = []
-    left_cursor = 0
-    for (deck_index, gap) in enumerate(gaps_until_next_stack):
-        left_cursor += gap
-        for i in range(num_starting_cards_per_stack):
-            if deck_index == 5:
-                continue
-            top_cursor = to_top_of_stacks_px + i * card_top_height_px
-            card_images.append(pil_image.crop(
-                (left_cursor, top_cursor, left_cursor + stack_width_px, top_cursor + card_image_height_px)))
-        left_cursor += stack_width_px
-
-    return card_images
+    image = np.asarray(pil_image)
+    lefts = np.array(total_gaps_until_stack) + np.arange(len(gaps_until_next_stack)) * stack_width_px
+    tops = to_top_of_stacks_px + np.arange(num_starting_cards_per_stack) * card_top_height_px
+    return [image[top:top + card_image_height_px, left:left + stack_width_px]
+            for (deck_index, left) in enumerate(lefts) if deck_index != 5
+            for top in tops]
 
 
 # now unused code to generate the card_images files, which is already done
 def save_all_cards_from_screen_to_disk(pil_image):
     card_images = get_card_images(pil_image)
     for i, card_image in enumerate(card_images):
-        card_image.save(f'card_images/card{i}.png')
+        PIL.Image.fromarray(card_image).save(f'card_images/card{i}.png')
+
+
+# the best (x, y, confidence) peaks in a heat map that are at least threshold, best first, up to max_peaks of them.
+# after each peak is found, the square around it is blanked out of the heat map (in place), so the next one
+# comes from somewhere else
+def find_peaks(heat_map, threshold, max_peaks, radius):
+    peaks = []
+    while len(peaks) < max_peaks:
+        (_, confidence, _, (x, y)) = cv2.minMaxLoc(heat_map)
+        if confidence < threshold:
+            break
+        peaks.append((x, y, confidence))
+        cv2.rectangle(heat_map, (x - radius, y - radius), (x + radius, y + radius), -1.0, thickness=-1)
+    return peaks
 
 
 def find_best_matches_for_image(needle, haystack):
     needle = pyscreeze._load_cv2(needle)
     haystack = pyscreeze._load_cv2(haystack)
     heat_map = cv2.matchTemplate(haystack, needle, cv2.TM_CCOEFF_NORMED)
-    locations = np.where(heat_map >= 0.8)
-    matches = [(x, y, confidence) for (x, y, confidence) in zip(*locations[::-1], heat_map[locations])]
-    return sorted(matches, key=lambda x: x[2], reverse=True)
-
-# the same as find_best_matches_for_image except:
-# if the card filename contains 'MAJ', then match using only the center 1/2 of the image
-# if the filename does not contain 'MAJ', then match only the left 1/2 of the image
-def find_best_matches_for_image_maj(needle_filename, haystack):
-    needle = pyscreeze._load_cv2(needle_filename)
-    haystack = pyscreeze._load_cv2(haystack)
+    return find_peaks(heat_map, 0.8, MAX_MATCHES_PER_CARD, 5)
+
+# cross-correlates every needle against the same haystack using the DFT. the haystack's spectrum and
+# integral images are computed once and shared by all of the needles, instead of cv2.matchTemplate
+# redoing that work for each one.
+# returns one heat map per needle, the same as cv2.matchTemplate(haystack, needle, cv2.TM_CCOEFF_NORMED)
+# the haystack and needles should already be float32, anything else gets converted on every call.
+# with use_opencl, the DFTs run through cv2.UMat, so the haystack spectrum stays on the GPU and only the
+# needles go up and the correlations come back down
+def batch_match(haystack, needles, use_opencl=False):
+    haystack = haystack.astype(np.float32, copy=False)
+    # TM_CCOEFF_NORMED doesn't change when a constant is added to the haystack, so subtract the mean to keep
+    # the DC component (and the float32 rounding error that comes along with it) out of the correlation
+    haystack = haystack - haystack.mean(axis=(0, 1)).astype(np.float32)
+    (haystack_height, haystack_width) = haystack.shape[:2]
+    dft_height = cv2.getOptimalDFTSize(haystack_height)
+    dft_width = cv2.getOptimalDFTSize(haystack_width)
+
+    def padded_spectrum(channel):
+        (channel_height, channel_width) = channel.shape
+        if use_opencl:
+            channel = cv2.UMat(channel)
+        padded = cv2.copyMakeBorder(channel, 0, dft_height - channel_height, 0, dft_width - channel_width,
+                                    cv2.BORDER_CONSTANT, value=0)
+        # the rows below the channel are all zero, so cv2.dft can skip transforming them. the channel is real, so
+        # its spectrum is symmetric, and the packed (CCS) format only computes and stores half of it
+        return cv2.dft(padded, nonzeroRows=channel_height)
+
+    haystack_spectra = [padded_spectrum(channel) for channel in cv2.split(haystack)]
+    haystack_sum, haystack_sqsum = cv2.integral2(haystack, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+
+    # the standard deviation of every needle-sized window in the haystack (over all channels) only depends
+    # on the needle size, and the cropped needles only come in a couple of sizes
+    window_deviations = {}
+
+    def window_deviation(needle_height, needle_width):
+        if (needle_height, needle_width) not in window_deviations:
+            def window_sum(integral):
+                return (integral[needle_height:, needle_width:] - integral[:-needle_height, needle_width:]
+                        - integral[needle_height:, :-needle_width] + integral[:-needle_height, :-needle_width])
+
+            variance = window_sum(haystack_sqsum) - window_sum(haystack_sum) ** 2 / (needle_height * needle_width)
+            variance = variance.reshape(variance.shape[:2] + (-1,)).sum(axis=2)
+            # like cv2.matchTemplate, treat (nearly) flat windows as having no deviation at all, so rounding
+            # error in them can't turn into a match
+            variance[variance <= 0.5] = 0
+            window_deviations[(needle_height, needle_width)] = np.sqrt(variance)
+        return window_deviations[(needle_height, needle_width)]
+
+    heat_maps = []
+    for needle in needles:
+        needle = needle.astype(np.float32, copy=False)
+        needle = needle - needle.mean(axis=(0, 1)).astype(np.float32)
+        (needle_height, needle_width) = needle.shape[:2]
+        # correlating against the zero mean needle gives the TM_CCOEFF numerator directly
+        correlation = None
+        for haystack_spectrum, needle_channel in zip(haystack_spectra, cv2.split(needle)):
+            spectrum = cv2.mulSpectrums(haystack_spectrum, padded_spectrum(needle_channel), 0, conjB=True)
+            channel_correlation = cv2.idft(spectrum, flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT)
+            correlation = channel_correlation if correlation is None else cv2.add(correlation, channel_correlation)
+        if use_opencl:
+            correlation = correlation.get()
+        correlation = correlation[:haystack_height - needle_height + 1, :haystack_width - needle_width + 1]
+
+        denominator = window_deviation(needle_height, needle_width) * np.sqrt(np.sum(needle * needle))
+        heat_map = np.zeros(correlation.shape, dtype=np.float32)
+        np.divide(correlation, denominator, out=heat_map, where=denominator > 0)
+        # and again like cv2.matchTemplate, anything far past a perfect match is rounding error, not a match
+        heat_map[np.abs(heat_map) >= 1.125] = 0
+        heat_maps.append(np.clip(heat_map, -1, 1, out=heat_map))
+    return heat_maps
+
+
+Needle = namedtuple('Needle', 'image small_image x_offset')
+
+
+# loads a card image as a grayscale float32 needle, cropped to the part of the card that tells it apart:
+# the center 1/4 for majors ('MAJ' in the filename), and the left edge for everything else.
+# also returns a copy shrunk by MATCH_SCALE, and the x offset of the crop that needs to be undone
+def load_needle_maj(needle_filename):
+    needle = pyscreeze._load_cv2(needle_filename, grayscale=True)
     orig_needle = needle
+    x_offset = 0
     if 'MAJ' in needle_filename:
         # cut 3px off the top
         # cut 2px off the bottom
         # and only match the center 1/4 of the card
         needle = needle[3:-2, needle.shape[1] * 3 // 8:needle.shape[1] * 5 // 8]
+        # if the card is a major, and we matched from the center, then restore the x position, making
+        # it seem like we matched from the left edge
+        x_offset = 3 * orig_needle.shape[1] // 8
     else:
         # only match the left 1/4 of the card, and shift to the right by 5px
         # extend to the right by 15px
         needle = needle[:, 5:(needle.shape[1] * 2 // 8) + 20]
 
     # cut 5px off the top and bottom of needle
-    needle = needle[5:needle.shape[0] - 5, :]
-
-    heat_map = cv2.matchTemplate(haystack, needle, cv2.TM_CCOEFF_NORMED)
-    locations = np.where(heat_map >= 0.8)
-    matches = [(x, y, confidence) for (x, y, confidence) in zip(*locations[::-1], heat_map[locations])]
-
-    # if the card is a major, and we matched from the center, then restore the x position, making
-    # it seem like we matched from the left edge
-    if 'MAJ' in needle_filename:
-        matches = [(x - (3*orig_needle.shape[1] // 8), y, confidence) for (x, y, confidence) in matches]
+    needle = needle[5:needle.shape[0] - 5, :].astype(np.float32)
+    small_needle = cv2.resize(needle, None, fx=1 / MATCH_SCALE, fy=1 / MATCH_SCALE, interpolation=cv2.INTER_AREA)
+    return Needle(image=needle, small_image=small_needle, x_offset=x_offset)
+
+
+# finds the exact location and confidence of a needle in the full size haystack, around a location that
+# was found at MATCH_RESOLUTION
+def refine_match(haystack, needle, x, y):
+    left = max(x * MATCH_SCALE - MATCH_SCALE, 0)
+    top = max(y * MATCH_SCALE - MATCH_SCALE, 0)
+    roi = haystack[top:top + needle.shape[0] + 2 * MATCH_SCALE, left:left + needle.shape[1] + 2 * MATCH_SCALE]
+    heat_map = cv2.matchTemplate(roi, needle, cv2.TM_CCOEFF_NORMED)
+    (_, confidence, _, (x, y)) = cv2.minMaxLoc(heat_map)
+    return (left + x, top + y, confidence)
+
+
+# pulls the matches for a needle loaded by load_needle_maj out of its heat map against the shrunken haystack.
+# shrinking blurs the cards a little, so anything that looks close is refined against the full size haystack,
+# and then has to pass the usual confidence threshold.
+# the haystack is only the CARD_ROWS of the screen, the matches are moved back to screen coordinates.
+# (that also keeps us from thinking the score counter is actually a major card, they use the same font)
+def find_best_matches_in_heat_map_maj(heat_map, haystack, needle):
+    # only the peaks, the pixels around a peak would just refine to the same match. every peak gets refined,
+    # how a peak ranks at MATCH_RESOLUTION says little about how it ranks at full size
+    peaks = find_peaks(heat_map, 0.65, np.inf, 2)
+    matches = (refine_match(haystack, needle.image, x, y) for (x, y, _) in peaks)
+    matches = [(x - needle.x_offset, y + CARD_ROWS[0], confidence)
+               for (x, y, confidence) in matches if confidence >= 0.8]
+    return sorted(matches, key=lambda x: x[2], reverse=True)[:MAX_MATCHES_PER_CARD]
+
+# the haystack and small haystack in shared memory, set by attach_shared_haystacks
+shared_haystacks = None
+
+
+# attaches to the shared haystacks. this is the pool worker initializer, so it happens once per worker instead
+# of once per task
+def attach_shared_haystacks(specs):
+    global shared_haystacks
+    shms = [shared_memory.SharedMemory(name=name) for (name, _, _) in specs]
+    shared_haystacks = (shms, [np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+                               for (shm, (_, shape, dtype)) in zip(shms, specs)])
+
+
+# runs in a pool worker: matches a chunk of the cards against the shared haystacks
+def locate_cards_in_shared_haystack(card_names):
+    (_, (haystack, small_haystack)) = shared_haystacks
+    heat_maps = batch_match(small_haystack, [NEEDLES[card_name].small_image for card_name in card_names],
+                            use_opencl=USE_OPENCL)
+    return [find_best_matches_in_heat_map_maj(heat_map, haystack, NEEDLES[card_name])
+            for (heat_map, card_name) in zip(heat_maps, card_names)]
+
+
+# the placement loop of locate_all_cards_on_screen_heuristic, over arrays: xs, ys and confidences are
+# (cards, MAX_MATCHES_PER_CARD), with the cards in the order they get placed, each card's matches best first,
+# and unused slots padded with a confidence of -inf.
+# returns the index of the match each card was placed at, or -1 if none of its matches were free
+def dedupe(xs, ys, confidences):
+    chosen = np.full(len(confidences), -1, dtype=np.int32)
+    placed_xy = np.zeros((len(confidences), 2), dtype=np.int32)
+    num_placed = 0
+    for card in range(len(confidences)):
+        for match in range(confidences.shape[1]):
+            if confidences[card, match] == -np.inf:
+                break
+            placed = placed_xy[:num_placed]
+            if np.any((np.abs(placed[:, 0] - xs[card, match]) < 5) & (np.abs(placed[:, 1] - ys[card, match]) < 5)):
+                continue
+            placed_xy[num_placed] = (xs[card, match], ys[card, match])
+            num_placed += 1
+            chosen[card] = match
+            break
+    return chosen
 
-    # prevents us from thinking the score counter is actually a major card, they use the same font
-    matches = (m for m in matches if m[0] >= 100 and m[1] >= 100)
-    return sorted(matches, key=lambda x: x[2], reverse=True)
 
 # same as locate_all_cards_on_screen, but prevents matching mistakes using the following heuristics:
 # 1. the most confident card matches take precedence
 # 2. if the location of a found card is within 5 square pixels of a previously found card, then continue to the next most confident location
-def locate_all_cards_on_screen_heuristic(pil_image):
+def locate_all_cards_on_screen_heuristic(haystack):
     all_locations = {}
-    all_card_files = glob.glob('card_images/*.png')
-    with multiprocessing.Pool() as pool:
-        results = pool.starmap(find_best_matches_for_image_maj, ((cf, pil_image) for cf in all_card_files))
+    # only search the rows the cards are in, and convert to grayscale float32 once here, rather than having cv2
+    # do it for every needle. the card fonts tell the cards apart just as well without color, for a third of
+    # the work
+    haystack = pyscreeze._load_cv2(haystack[CARD_ROWS[0]:CARD_ROWS[1]], grayscale=True).astype(np.float32)
+
+    # find the cards at MATCH_RESOLUTION first, the DFTs are much smaller there
+    small_haystack = cv2.resize(haystack, MATCH_RESOLUTION, interpolation=cv2.INTER_AREA)
+    # the haystacks are shared with the workers instead of being sent along with every task
+    (_, (shared_haystack, shared_small_haystack)) = shared_haystacks
+    shared_haystack[:] = haystack
+    shared_small_haystack[:] = small_haystack
+
+    if USE_OPENCL:
+        # the GPU is already doing the DFTs in parallel, and forked workers can't share its context, so match
+        # all of the cards right here
+        card_name_chunks = [list(NEEDLES)]
+        chunk_results = [locate_cards_in_shared_haystack(list(NEEDLES))]
+    else:
+        # each worker gets a chunk of the cards, so the haystack DFT is done once per worker rather than once
+        # per card
+        card_name_chunks = [list(NEEDLES)[i::NUM_WORKERS] for i in range(NUM_WORKERS)]
+        chunk_results = POOL.map(locate_cards_in_shared_haystack, card_name_chunks)
 
-    card_names = [cf.split('/')[1].split('.')[0] for cf in all_card_files]
-    results_with_card_names = zip(card_names, results)
+    results_with_card_names = [(card_name, results) for (card_names, chunk) in zip(card_name_chunks, chunk_results)
+                               for (card_name, results) in zip(card_names, chunk)]
     # sort results by the max confidence
     results_with_card_names = sorted(results_with_card_names, key=lambda x: x[1][0][2], reverse=True)
 
-    for card_name, results in results_with_card_names:
-        for x, y, confidence in results:
-            if any((x - 5) < prev_x < (x + 5) and (y - 5) < prev_y < (y + 5) for prev_x, prev_y, _ in
-                   all_locations.values()):
-                continue
-            all_locations[card_name] = (x, y, confidence)
-            break
+    xs = np.zeros((len(results_with_card_names), MAX_MATCHES_PER_CARD), dtype=np.int32)
+    ys = np.zeros_like(xs)
+    confidences = np.full(xs.shape, -np.inf, dtype=np.float32)
+    for card, (_, results) in enumerate(results_with_card_names):
+        for match, (x, y, confidence) in enumerate(results):
+            (xs[card, match], ys[card, match], confidences[card, match]) = (x, y, confidence)
+
+    for (card_name, results), match in zip(results_with_card_names, dedupe(xs, ys, confidences)):
+        if match != -1:
+            all_locations[card_name] = results[match]
 
     return all_locations
 
 
-window_geom = dict(line.split('=') for line in getoutput(f'xdotool getwindowgeometry --shell {window_id}').splitlines())
-for key in window_geom:
-    try:
-        window_geom[key] = int(window_geom[key])
-    except ValueError:
-        pass
+# the same as xdotool getwindowgeometry, with the position of the window on the whole desktop
+window_size = game_window.get_geometry()
+window_position = x_display.screen().root.translate_coords(game_window, 0, 0)
+window_geom = {'X': window_position.x, 'Y': window_position.y, 'WIDTH': window_size.width, 'HEIGHT': window_size.height}
 
 game_window_x_offset = window_geom['X']
 game_window_y_offset = window_geom['Y']
 
 TARGET_RESOLUTION = (2160, 1216)  # the resolution when i had it running on my second monitor
+# the cards are all dealt into these rows of the screen (with a little slack), so that's all that gets searched
+CARD_ROWS = (to_top_of_stacks_px - 10,
+             to_top_of_stacks_px + num_starting_cards_per_stack * card_top_height_px + card_image_height_px + 10)
+CARD_ROWS_RESOLUTION = (TARGET_RESOLUTION[0], CARD_ROWS[1] - CARD_ROWS[0])
+# cards are first located on a copy of the card rows shrunk by MATCH_SCALE in each direction, which makes the
+# DFTs MATCH_SCALE ** 2 times smaller, and then refined at TARGET_RESOLUTION
+MATCH_SCALE = 2
+MATCH_RESOLUTION = (CARD_ROWS_RESOLUTION[0] // MATCH_SCALE, CARD_ROWS_RESOLUTION[1] // MATCH_SCALE)
+# how many refined candidate locations to keep for each card, in case the best one is taken by a more confident
+# card
+MAX_MATCHES_PER_CARD = 10
+
+# load and crop all the card images once, instead of every time we look at the screen
+NEEDLES = {cf.split('/')[1].split('.')[0]: load_needle_maj(cf) for cf in glob.glob('card_images/*.png')}
+
+# the haystacks are the same size every game, so they get shared memory for the whole run, and a pool of
+# workers that attach to it once and then stick around, instead of starting up new workers every game
+haystack_channels = next(iter(NEEDLES.values())).image.shape[2:]
+haystack_itemsize = np.dtype(np.float32).itemsize * int(np.prod(haystack_channels))
+shared_haystack_resolutions = (CARD_ROWS_RESOLUTION, MATCH_RESOLUTION)
+shared_haystack_shms = [shared_memory.SharedMemory(create=True, size=width * height * haystack_itemsize)
+                        for (width, height) in shared_haystack_resolutions]
+shared_haystack_specs = [(shm.name, (height, width) + haystack_channels, np.float32)
+                         for (shm, (width, height)) in zip(shared_haystack_shms, shared_haystack_resolutions)]
+attach_shared_haystacks(shared_haystack_specs)
+
+# match on the GPU when cv2 is using OpenCL on one, otherwise spread the matching over a pool of worker processes.
+# a CPU OpenCL runtime (like pocl) would match all of the cards one after another in this process
+USE_OPENCL = cv2.ocl.useOpenCL() and bool(cv2.ocl.Device.getDefault().type() & cv2.ocl.Device_TYPE_GPU)
+NUM_WORKERS = os.cpu_count()
+POOL = ProcessPoolExecutor(max_workers=NUM_WORKERS, initializer=attach_shared_haystacks,
+                           initargs=(shared_haystack_specs,))
+
+
+def shut_down_pool():
+    POOL.shutdown()
+    for shm in shared_haystack_shms:
+        shm.unlink()
+
+
+atexit.register(shut_down_pool)
 
 # HAXX
 orig_window_size = None
 
 
+# the raw pixels of the game window, without encoding them to an image file and back
+def grab_game_window():
+    geometry = game_window.get_geometry()
+    image = game_window.get_image(0, 0, geometry.width, geometry.height, X.ZPixmap, 0xffffffff)
+    # a 24 bit deep window comes back with 32 bits per pixel, in BGRX order
+    bits_per_pixel = next(pixmap_format.bits_per_pixel for pixmap_format in x_display.info.pixmap_formats
+                          if pixmap_format.depth == image.depth)
+    assert bits_per_pixel == 32, f'window has {bits_per_pixel} bits per pixel'
+    # python-xlib hands the pixels back as a str when they happen to be valid UTF-8 (like an all black window),
+    # encoding them again gets back the same bytes
+    data = image.data.encode('utf-8') if isinstance(image.data, str) else image.data
+    return np.frombuffer(data, dtype=np.uint8).reshape(geometry.height, geometry.width, 4)
+
+
 def solve_screen():
     global orig_window_size
 
-    xwd_bytes = os.popen(f'xwd -id {window_id}')
+    image = grab_game_window()
+    height, width = image.shape[:2]
 
-    pil_image = PIL.Image.open(io.BytesIO(check_output(['convert', 'xwd:-', 'png:-'], stdin=xwd_bytes)))
-
-    # make sure pil_image dimensions and window_geom dimensions are within 5px of each other
+    # make sure image dimensions and window_geom dimensions are within 5px of each other
     # (accounting for window borders)
-    assert abs(pil_image.width - window_geom['WIDTH']) < 5
-    assert abs(pil_image.height - window_geom['HEIGHT']) < 5
+    assert abs(width - window_geom['WIDTH']) < 5
+    assert abs(height - window_geom['HEIGHT']) < 5
 
-    orig_window_size = (pil_image.width, pil_image.height)
+    orig_window_size = (width, height)
 
     # crop the image to 16:9, removing black bars on either the top/bottom or left/right
-    width, height = pil_image.size
     if width / height > 16 / 9:
         # remove left/right
-        pil_image = pil_image.crop((width / 2 - height * 16 / 9 / 2, 0, width / 2 + height * 16 / 9 / 2, height))
+        image = image[:, round(width / 2 - height * 16 / 9 / 2):round(width / 2 + height * 16 / 9 / 2)]
     else:
         # remove top/bottom
-        pil_image = pil_image.crop((0, height / 2 - width * 9 / 16 / 2, width, height / 2 + width * 9 / 16 / 2))
+        image = image[round(height / 2 - width * 9 / 16 / 2):round(height / 2 + width * 9 / 16 / 2), :]
 
-    # scale pil_image to TARGET_RESOLUTION
-    pil_image = pil_image.resize(TARGET_RESOLUTION)
+    # scale image to TARGET_RESOLUTION, and drop the unused X channel
+    haystack = cv2.cvtColor(cv2.resize(image, TARGET_RESOLUTION, interpolation=cv2.INTER_AREA), cv2.COLOR_BGRA2BGR)
 
     print('locating all cards on the screen...')
-    all_cards_on_screen = locate_all_cards_on_screen_heuristic(pil_image)
+    all_cards_on_screen = locate_all_cards_on_screen_heuristic(haystack)
 
     print(len(all_cards_on_screen))
 
@@ -180,42 +420,35 @@ def solve_screen():
     print(len(all_cards_on_screen.values()))
     print(len(set(all_cards_on_screen.values())))
 
-    # print out all the duplicates in all_cards_on_screen
-    for card, location in all_cards_on_screen.items():
-        if list(all_cards_on_screen.values()).count(location) > 1:
-            print(card, location)
+    # print out all the duplicates in all_cards_on_screen (only useful alongside the asserts, so skip it with -O)
+    if __debug__:
+        location_counts = Counter(all_cards_on_screen.values())
+        for card, location in all_cards_on_screen.items():
+            if location_counts[location] > 1:
+                print(card, location)
 
     assert len(set(all_cards_on_screen.values())) == 70
 
     # organize the cards into stacks, based roughly on their x and y coordinates
     # cards that are roughly the same x coordinate are in the same stack, with increasing y coordinates
+    card_names = list(all_cards_on_screen)
+    card_xys = np.array([all_cards_on_screen[card_name][:2] for card_name in card_names])
+    # sort the cards by x coordinate, and start a new stack wherever x jumps
+    by_x = np.argsort(card_xys[:, 0], kind='stable')
+    stack_starts = np.flatnonzero(np.diff(card_xys[by_x, 0]) >= 10) + 1
     stacks = []
-    for card_name, (x, y, confidence) in all_cards_on_screen.items():
-        for stack in stacks:
-            if abs(stack[0][0] - x) < 10:
-                stack.append((x, y, card_name))
-                break
-        else:
-            stacks.append([(x, y, card_name)])
-
-    # sort each stack by y coordinate
-    for stack in stacks:
-        stack.sort(key=lambda x: x[1])
-    # sort all stacks by x coordinate
-    stacks.sort(key=lambda x: x[0][0])
+    for stack_indices in np.split(by_x, stack_starts):
+        # sort each stack by y coordinate
+        stack_indices = stack_indices[np.argsort(card_xys[stack_indices, 1], kind='stable')]
+        stacks.append([(*card_xys[i].tolist(), card_names[i]) for i in stack_indices])
 
     # validate that each stack has the correct number of cards
     for i, stack in enumerate(stacks):
         assert len(stack) == 7, f'stack {i} has {len(stack)} cards: {stack}'
 
-    stacks_str = ''
-    for i, stack in enumerate(stacks):
-        stacks_str += ','.join(card[2] for card in stack)
-        if i == 4:
-            stacks_str += '\n'
-        stacks_str += '\n'
-
-    stacks_str = stacks_str.strip()
+    # one line per stack, with a blank line between the first five stacks and the rest
+    rows = [','.join(card[2] for card in stack) for stack in stacks]
+    stacks_str = '\n'.join(rows[:5]) + '\n\n' + '\n'.join(rows[5:])
     print('found the following stacks on screen:')
     print(stacks_str)
 
@@ -247,7 +480,7 @@ def convert_stack_pos_to_game_screen_px(pos):
     if pos == 'BLOCK':
         return BLOCK_POSITION_IN_GAME_SCREEN
     (stack_number, depth) = pos
-    x = sum(gaps_until_next_stack[0:stack_number + 1]) + stack_width_px * stack_number
+    x = total_gaps_until_stack[stack_number] + stack_width_px * stack_number
     y = to_top_of_stacks_px + depth * card_top_height_px
     # offset by half the width of the stack, so we're grabbing by the center of the card
     x += stack_width_px / 2
@@ -256,11 +489,11 @@ def convert_stack_pos_to_game_screen_px(pos):
     return (x, y)
 
 
-# write a function to convert game screen coordinates into entire desktop coordinates,
+# the scale and offset to convert game screen coordinates into entire desktop coordinates,
 # accounting for the position of the window on the desktop, adding back in the black bars that
-# were cropped out, and scaling up to the original resolution
-def convert_game_screen_px_to_desktop_px(pos):
-    (x, y) = pos
+# were cropped out, and scaling up to the original resolution.
+# desktop_px = game_screen_px * scale + offset, which works on a whole array of positions at once
+def game_screen_to_desktop_transform():
     (window_x, window_y) = (game_window_x_offset, game_window_y_offset)
     (window_width, window_height) = orig_window_size
     (target_width, target_height) = TARGET_RESOLUTION
@@ -274,9 +507,25 @@ def convert_game_screen_px_to_desktop_px(pos):
         window_y += (window_height - window_width * 9 / 16) / 2
         window_height = window_width * 9 / 16
     # scale up to the original resolution
-    x = window_x + x * window_width / target_width
-    y = window_y + y * window_height / target_height
-    return (x, y)
+    scale = np.array([window_width / target_width, window_height / target_height])
+    offset = np.array([window_x, window_y])
+    return (scale, offset)
+
+
+def convert_game_screen_px_to_desktop_px(pos):
+    (scale, offset) = game_screen_to_desktop_transform()
+    return tuple((np.asarray(pos) * scale + offset).tolist())
+
+
+# the same as xdotool mousemove and click, through the XTEST extension
+def click_desktop_px(x, y):
+    xtest.fake_input(x_display, X.MotionNotify, x=round(x), y=round(y))
+    xtest.fake_input(x_display, X.ButtonPress, 1)
+    x_display.sync()
+    # xdotool also waits a little between pressing and releasing
+    time.sleep(0.012)
+    xtest.fake_input(x_display, X.ButtonRelease, 1)
+    x_display.sync()
 
 
 CLOSE_WIN_SCREEN_BUTTON_POS = (2095, 49)
@@ -296,20 +545,25 @@ while True:
 
     moves = list(map(parse_move, move_list_str.strip().splitlines()))
 
-    # first use xdotool to click the center of the window, to activate it
+    # first click the center of the window, to activate it
     window_center = (game_window_x_offset + orig_window_size[0] / 2, game_window_y_offset + orig_window_size[1] / 2)
-    check_output(['xdotool', 'mousemove', str(window_center[0]), str(window_center[1])])
-    check_output(['xdotool', 'click', '1'])
+    click_desktop_px(*window_center)
+
+    # work out where on the desktop every move starts and ends up front, the window doesn't move during a game
+    (scale, offset) = game_screen_to_desktop_transform()
+    src_game_screen_px = np.array([convert_stack_pos_to_game_screen_px(move.src) for move in moves]).reshape(-1, 2)
+    dst_game_screen_px = np.array([convert_stack_pos_to_game_screen_px(move.dst) for move in moves]).reshape(-1, 2)
+    src_desktop_px = (src_game_screen_px * scale + offset).tolist()
+    dst_desktop_px = (dst_game_screen_px * scale + offset).tolist()
 
     print(f'solved in {len(moves)} moves')
-    for move in moves:
+    for (move, src_px, dst_px) in zip(moves, src_desktop_px, dst_desktop_px):
         # sleep longer the more sucks there are
         sleep_time = 0.2 * (1 + (2 * move.num_sucks))
 
         print(f'{move.human_readable} ({move.num_sucks} sucks, sleep {sleep_time}s)')
-        pyautogui.moveTo(*convert_game_screen_px_to_desktop_px(convert_stack_pos_to_game_screen_px(move.src)))
-        pyautogui.dragTo(*convert_game_screen_px_to_desktop_px(convert_stack_pos_to_game_screen_px(move.dst)),
-                         duration=0.3)
+        pyautogui.moveTo(*src_px)
+        pyautogui.dragTo(*dst_px, duration=0.3)
         print('sleeping for', sleep_time)
         time.sleep(sleep_time)
 